@@ -1,20 +1,35 @@
 # videotovideogen_main.py
 
-from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File
+from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, ConfigDict, HttpUrl
 import os
 import uuid
-import requests
+import shutil
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
-import io
+import re
+import json
+import hashlib
+import hmac
+import logging
+from urllib.parse import quote, urlparse, unquote
 import asyncio
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+
+import anyio.to_thread
+import httpx
 
 # RunwayML SDK
 try:
-    from runwayml import RunwayML
+    from runwayml import AsyncRunwayML
     RUNWAY_SDK_AVAILABLE = True
 except ImportError:
     RUNWAY_SDK_AVAILABLE = False
@@ -22,7 +37,39 @@ except ImportError:
 # -----------------------------------------------------------------------------
 # App & CORS
 # -----------------------------------------------------------------------------
-app = FastAPI(title="Video-to-Video Generation API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connection pools are built per worker process, inside its own event loop
+    global HTTP, RUNWAY_CLIENT, s3_client, rekognition, sqs
+    # UploadFile I/O and other blocking helpers share anyio's thread pool (40 by default)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    s3_client = _new_aws_client("s3")
+    rekognition = _new_aws_client("rekognition")
+    if MODERATION_NOTIFICATIONS:
+        sqs = _new_aws_client("sqs")
+    HTTP = _new_http_client()
+    if RUNWAY_SDK_AVAILABLE:
+        RUNWAY_CLIENT = AsyncRunwayML(api_key=RUNWAY_API_KEY)
+    if MODERATION_NOTIFICATIONS:
+        _start_moderation_consumer()
+    yield
+    if MODERATION_CONSUMER:
+        MODERATION_CONSUMER.cancel()
+    await HTTP.aclose()
+    if RUNWAY_CLIENT is not None:
+        await RUNWAY_CLIENT.close()
+
+app = FastAPI(title="Video-to-Video Generation API", version="1.0.0", lifespan=lifespan)
+
+# Declared before CORS so rejections still carry CORS headers
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    if request.url.path == "/upload-video":
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > MAX_UPLOAD_BYTES:
+            return JSONResponse(status_code=413, content={"error": "Video is too large."})
+    return await call_next(request)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -34,6 +81,8 @@ app.add_middleware(
 # -----------------------------------------------------------------------------
 # Config / Clients
 # -----------------------------------------------------------------------------
+logger = logging.getLogger("videotovideogen")
+
 RUNWAY_API_KEY = os.getenv("RUNWAYML_API_SECRET")
 if not RUNWAY_API_KEY:
     raise RuntimeError("RUNWAYML_API_SECRET environment variable is missing")
@@ -47,26 +96,149 @@ if not (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY):
 
 BUCKET_NAME = "image-to-video-library"
 
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
+# Room for the upload/moderation fan-out; the default pool of 10 queues requests under load
+AWS_MAX_POOL_CONNECTIONS = 64
+AWS_CLIENT_CONFIG = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    tcp_keepalive=True,
 )
 
-rekognition = boto3.client(
-    "rekognition",
+# One session per process: credential and endpoint resolution happen once, not per client
+AWS_SESSION = boto3.Session(
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
     region_name=AWS_REGION,
 )
 
-RUNWAY_CLIENT = RunwayML(api_key=RUNWAY_API_KEY) if RUNWAY_SDK_AVAILABLE else None
+def _new_aws_client(service: str):
+    return AWS_SESSION.client(service, config=AWS_CLIENT_CONFIG)
+
+# Clients are built once per worker in lifespan and shared by every request and executor
+# thread. boto3 clients (unlike resources and sessions) are thread-safe, and reusing them
+# keeps TLS connections warm in the pool instead of paying a handshake per call.
+s3_client = None
+rekognition = None
+sqs = None  # only with MODERATION_NOTIFICATIONS
+
+# Optional Rekognition completion notifications: Rekognition -> SNS topic -> SQS queue
+REKOGNITION_SNS_TOPIC_ARN = os.getenv("REKOGNITION_SNS_TOPIC_ARN")
+REKOGNITION_ROLE_ARN = os.getenv("REKOGNITION_ROLE_ARN")
+REKOGNITION_SQS_QUEUE_URL = os.getenv("REKOGNITION_SQS_QUEUE_URL")
+MODERATION_NOTIFICATIONS = bool(
+    REKOGNITION_SNS_TOPIC_ARN and REKOGNITION_ROLE_ARN and REKOGNITION_SQS_QUEUE_URL
+)
+MODERATION_TIMEOUT_SECONDS = 600
+MODERATION_REJECTED_DETAIL = "Video flagged by content moderation"
+# Start Runway while external inputs are still being moderated; set to "false" to only
+# submit content that has already passed moderation
+MODERATION_OVERLAP = os.getenv("MODERATION_OVERLAP", "true").lower() != "false"
+# Object tag recording the moderation verdict of a (content-addressed) upload
+MODERATION_TAG = "moderation"
+# With notifications enabled polling is only a safety net, so it can back off further
+MODERATION_MAX_POLL_SECONDS = 60 if MODERATION_NOTIFICATIONS else 15
+
+# Optional frame-sampled pre-moderation; skipped when ffmpeg/ffprobe aren't installed
+FFMPEG_BIN = shutil.which("ffmpeg")
+FFPROBE_BIN = shutil.which("ffprobe")
+PREMODERATION_FRAMES = 4
+# Hard limit per ffmpeg/ffprobe run, and the stall limit on their reads of the video URL
+FFMPEG_TIMEOUT_SECONDS = 60
+FFMPEG_RW_TIMEOUT_US = str(15 * 1_000_000)
+# Optional cap on input length, checked with ffprobe before any Rekognition job (0 = no limit).
+# It fails closed: ffprobe must be installed, and videos of unknown length are refused.
+MAX_VIDEO_SECONDS = int(os.getenv("MAX_VIDEO_SECONDS", "0"))
+if MAX_VIDEO_SECONDS and not FFPROBE_BIN:
+    raise RuntimeError("MAX_VIDEO_SECONDS is set but ffprobe is not installed")
+
+# Rekognition JobId -> Future resolved by the SQS consumer
+MODERATION_WAITERS: dict[str, asyncio.Future] = {}
+MODERATION_CONSUMER: asyncio.Task | None = None
+
+# Output cache key -> pipeline task for generations currently in progress
+INFLIGHT: dict[str, asyncio.Task] = {}
+
+RUNWAY_CLIENT = None  # AsyncRunwayML, created in lifespan
+RUNWAY_TIMEOUT_SECONDS = 600
+# Always Gen 4 Aleph, whatever the request's `model` says
+RUNWAY_MODEL = "gen4_aleph"
+# When Runway is set up to call /runway-callback?token=..., waiters wake on the callback
+# and polling becomes a slow safety net
+RUNWAY_CALLBACK_TOKEN = os.getenv("RUNWAY_CALLBACK_TOKEN")
+RUNWAY_MAX_POLL_SECONDS = 30 if RUNWAY_CALLBACK_TOKEN else 15
+
+# Runway task id -> Event set by /runway-callback
+RUNWAY_WAITERS: dict[str, asyncio.Event] = {}
+
+# Size of the anyio thread pool behind run_in_threadpool and UploadFile reads
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "64"))
+
+# boto3 is synchronous; its calls run on this pool so they don't stall the event loop
+AWS_EXECUTOR = ThreadPoolExecutor(max_workers=AWS_MAX_POOL_CONNECTIONS)
+
+# S3 multipart: parts must be >= 5 MiB (except the last one)
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 8
+
+# Uploaded files are pushed in parallel parts with bounded memory; larger parts
+# mean fewer requests and noticeably better throughput on big videos
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# A multipart transfer buffers its parts in flight plus one queued and one being read;
+# larger parts get fewer parallel workers so each transfer stays within this much memory
+S3_TRANSFER_BUFFER_BYTES = 128 * 1024 * 1024
+
+# Past a point more simultaneous S3 transfers per worker only add pool/TLS contention.
+# Buffered transfer memory per worker is at most this times S3_TRANSFER_BUFFER_BYTES (1 GiB).
+S3_MAX_CONCURRENT_TRANSFERS = int(os.getenv("S3_MAX_CONCURRENT_TRANSFERS", "8"))
+S3_SEM = asyncio.Semaphore(S3_MAX_CONCURRENT_TRANSFERS)
+
+# Buckets we may read with our own credentials for server-side copies. Anything else is
+# fetched like any other URL, so a caller can't pull objects only our IAM role can read.
+S3_COPY_SOURCE_BUCKETS = {
+    b.strip() for b in os.getenv("S3_COPY_SOURCE_BUCKETS", "").split(",") if b.strip()
+}
+
+# Server-side copies of objects that already live in S3
+COPY_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+)
+
+# Shared keep-alive pool for external downloads and Runway outputs (created in lifespan)
+def _new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        http2=True,
+        timeout=300,
+        follow_redirects=True,
+    )
+
+HTTP: httpx.AsyncClient
+
+# Source videos, uploaded or copied in from external URLs
+UPLOAD_KEY_PREFIX = "uploads/video/"
+
+# Accepted extensions -> container family they must sniff as
+VIDEO_CONTAINERS = {"mp4": "isobmff", "m4v": "isobmff", "mov": "isobmff", "webm": "ebml"}
+# Top-level atoms that can open a QuickTime file written without an ftyp box
+QUICKTIME_ATOMS = {b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"}
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(1024 * 1024 * 1024)))
+
+# Generated outputs are copied from Runway to S3 in larger parts for throughput
+OUTPUT_PART_SIZE = 32 * 1024 * 1024
+
+# Lifetime of the download links handed back by /generate-video
+PRESIGNED_URL_TTL_SECONDS = int(os.getenv("PRESIGNED_URL_TTL_SECONDS", "3600"))
 
 # -----------------------------------------------------------------------------
 # Models
 # -----------------------------------------------------------------------------
 class VideoToVideoRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
     video: HttpUrl
     prompt_text: str
     model: str = "gen4_aleph"  # updated to Gen 4 Aleph
@@ -75,78 +247,562 @@ class VideoToVideoRequest(BaseModel):
 # -----------------------------------------------------------------------------
 # Helpers
 # -----------------------------------------------------------------------------
+S3_VHOST_PREFIX = f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/"
+_S3_URL_RE = re.compile(r"^(?:s3://|https://[^/]+\.amazonaws\.com/)")
+
 def _is_s3_url(url: str) -> bool:
-    return url.startswith("s3://") or (".amazonaws.com/" in url and url.startswith("https://"))
+    return _S3_URL_RE.match(url) is not None
+
+_S3_VHOST_RE = re.compile(r"^(?P<bucket>.+)\.s3[.-](?:[a-z0-9-]+\.)*amazonaws\.com$")
+_S3_PATH_HOST_RE = re.compile(r"^s3[.-](?:[a-z0-9-]+\.)*amazonaws\.com$")
+
+def _s3_location(url: str) -> tuple[str, str] | None:
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    path = unquote(parsed.path).lstrip("/")
+    if parsed.scheme == "s3":
+        bucket, key = parsed.netloc, path
+    elif match := _S3_VHOST_RE.match(host):
+        bucket, key = match["bucket"], path
+    elif _S3_PATH_HOST_RE.match(host) and "/" in path:
+        bucket, key = path.split("/", 1)
+    else:
+        return None
+    return (bucket, key) if bucket and key else None
 
 def _s3_key_from_presigned_or_path(url: str) -> str:
-    prefix = f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/"
-    if url.startswith(prefix):
-        return url[len(prefix):]
-    path_prefix = f"https://s3.{AWS_REGION}.amazonaws.com/{BUCKET_NAME}/"
-    if url.startswith(path_prefix):
-        return url[len(path_prefix):]
-    if url.startswith("s3://"):
-        parts = url.replace("s3://", "").split("/", 1)
-        if len(parts) == 2 and parts[0] == BUCKET_NAME:
-            return parts[1]
+    # Matched on the parsed host so presigned query strings and escaped keys are handled
+    location = _s3_location(url)
+    if location and location[0] == BUCKET_NAME:
+        return location[1]
     return ""
 
+def _video_container(head: bytes) -> str | None:
+    if head[4:8] == b"ftyp" or head[4:8] in QUICKTIME_ATOMS:
+        return "isobmff"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "ebml"
+    return None
+
 def _public_s3_url(key: str) -> str:
-    return f"https://{BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{key}"
+    # Keys are stored decoded; spaces, "?" and the like must be escaped again in the URL
+    return S3_VHOST_PREFIX + quote(key)
+
+async def _aws(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(AWS_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+async def _multipart_upload(chunks: AsyncIterator[bytes], key: str, content_type: str) -> None:
+    chunks = aiter(chunks)
+    first = await anext(chunks, b"")
+    if not first:
+        raise HTTPException(status_code=400, detail="Video is empty")
+    second = await anext(chunks, None)
+    if second is None:
+        # Fits in one part: a single PUT, no multipart upload to create or abort
+        await _aws(s3_client.put_object, Bucket=BUCKET_NAME, Key=key, Body=first, ContentType=content_type)
+        return
+
+    upload = await _aws(
+        s3_client.create_multipart_upload, Bucket=BUCKET_NAME, Key=key, ContentType=content_type
+    )
+    upload_id = upload["UploadId"]
+    concurrency = max(1, min(MULTIPART_CONCURRENCY, S3_TRANSFER_BUFFER_BYTES // len(first) - 2))
+    # Workers pull parts as soon as they're read, so one part of read-ahead is enough
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    etags: dict[int, str] = {}
+
+    async def produce():
+        await queue.put((1, first))
+        await queue.put((2, second))
+        part_number = 2
+        async for chunk in chunks:
+            part_number += 1
+            await queue.put((part_number, chunk))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def consume():
+        while (item := await queue.get()) is not None:
+            part_number, body = item
+            part = await _aws(
+                s3_client.upload_part,
+                Bucket=BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+            etags[part_number] = part["ETag"]
+
+    tasks = [asyncio.create_task(produce())]
+    tasks += [asyncio.create_task(consume()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+        await _aws(
+            s3_client.complete_multipart_upload,
+            Bucket=BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": n, "ETag": etags[n]} for n in sorted(etags)]},
+        )
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        try:
+            await _aws(s3_client.abort_multipart_upload, Bucket=BUCKET_NAME, Key=key, UploadId=upload_id)
+        except (BotoCoreError, ClientError):
+            pass
+        raise
+
+async def _iter_upload(file: UploadFile, chunk_size: int) -> AsyncIterator[bytes]:
+    while chunk := await file.read(chunk_size):
+        yield chunk
+
+async def _limit_video_stream(
+    chunks: AsyncIterator[bytes], max_bytes: int, sniff: bool
+) -> AsyncIterator[bytes]:
+    # Checked as the bytes arrive, so nothing reaches S3 past the cap or before the sniff
+    total = 0
+    async for chunk in chunks:
+        if sniff and total == 0 and _video_container(chunk[:16]) is None:
+            raise HTTPException(status_code=415, detail="Source is not a supported video.")
+        total += len(chunk)
+        if total > max_bytes:
+            raise HTTPException(status_code=413, detail="Video is too large.")
+        yield chunk
+
+async def _copy_url_to_bucket(
+    url: str, key: str, content_type: str, part_size: int = MULTIPART_PART_SIZE, sniff: bool = False
+) -> None:
+    async with S3_SEM, HTTP.stream("GET", url) as resp:
+        resp.raise_for_status()
+        length = resp.headers.get("content-length", "")
+        if length.isdigit() and int(length) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Video is too large.")
+        chunks = _limit_video_stream(resp.aiter_bytes(chunk_size=part_size), MAX_UPLOAD_BYTES, sniff)
+        await _multipart_upload(chunks, key, content_type)
 
 async def _copy_external_video_to_bucket(external_url: str) -> str:
     ext = "mp4"
     if "." in external_url.split("?")[0]:
         maybe_ext = external_url.split("?")[0].split(".")[-1].lower()
-        if maybe_ext in ["mp4", "mov", "webm", "m4v"]:
+        if maybe_ext in VIDEO_CONTAINERS:
             ext = maybe_ext
-    unique_key = f"uploads/video/{uuid.uuid4()}.{ext}"
-    resp = requests.get(external_url, stream=True, timeout=60)
-    resp.raise_for_status()
-    s3_client.upload_fileobj(resp.raw, BUCKET_NAME, unique_key, ExtraArgs={"ContentType": f"video/{ext}"})
+    unique_key = f"{UPLOAD_KEY_PREFIX}{uuid.uuid4()}.{ext}"
+
+    # Objects in trusted buckets are copied server-side; fall back to streaming if we can't read them
+    location = _s3_location(external_url)
+    if location and location[0] in S3_COPY_SOURCE_BUCKETS:
+        src_bucket, src_key = location
+        try:
+            async with S3_SEM:
+                await _aws(
+                    s3_client.copy,
+                    {"Bucket": src_bucket, "Key": src_key},
+                    BUCKET_NAME,
+                    unique_key,
+                    ExtraArgs={"ContentType": f"video/{ext}", "MetadataDirective": "REPLACE"},
+                    Config=COPY_TRANSFER_CONFIG,
+                )
+            return unique_key
+        except (BotoCoreError, ClientError):
+            pass
+
+    try:
+        await _copy_url_to_bucket(external_url, unique_key, f"video/{ext}", sniff=True)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=400, detail=f"Could not download source video: {e}")
     return unique_key
 
+async def _consume_moderation_notifications() -> None:
+    while True:
+        try:
+            resp = await _aws(
+                sqs.receive_message,
+                QueueUrl=REKOGNITION_SQS_QUEUE_URL,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=20,
+                AttributeNames=["ApproximateReceiveCount"],
+            )
+        except (BotoCoreError, ClientError):
+            await asyncio.sleep(5)
+            continue
+        for message in resp.get("Messages", []):
+            try:
+                await _handle_moderation_notification(message)
+            except Exception:
+                logger.exception("Could not handle moderation notification %s", message.get("MessageId"))
+
+async def _handle_moderation_notification(message: dict) -> None:
+    receipt = message["ReceiptHandle"]
+    try:
+        body = json.loads(message["Body"])
+        # SNS wraps the Rekognition payload unless raw delivery is enabled
+        if isinstance(body, dict) and "Message" in body:
+            body = json.loads(body["Message"])
+        notification = body if isinstance(body, dict) else {}
+    except (ValueError, TypeError):
+        notification = {}
+    job_id = notification.get("JobId")
+    waiter = MODERATION_WAITERS.get(job_id) if isinstance(job_id, str) else None
+    try:
+        receive_count = int(message.get("Attributes", {}).get("ApproximateReceiveCount", 1))
+        if waiter is None and notification and receive_count < 10:
+            # Most likely another worker's job: hand it back to the queue
+            await _aws(
+                sqs.change_message_visibility,
+                QueueUrl=REKOGNITION_SQS_QUEUE_URL,
+                ReceiptHandle=receipt,
+                VisibilityTimeout=1,
+            )
+            return
+        if waiter is not None and not waiter.done():
+            waiter.set_result(notification.get("Status"))
+        await _aws(sqs.delete_message, QueueUrl=REKOGNITION_SQS_QUEUE_URL, ReceiptHandle=receipt)
+    except (BotoCoreError, ClientError):
+        pass
+
+def _start_moderation_consumer() -> None:
+    global MODERATION_CONSUMER
+    MODERATION_CONSUMER = asyncio.create_task(_consume_moderation_notifications())
+    MODERATION_CONSUMER.add_done_callback(_on_moderation_consumer_done)
+
+def _on_moderation_consumer_done(task: asyncio.Task) -> None:
+    if task.cancelled():
+        return
+    # Without the consumer every wait silently degrades to slow polling, so bring it back
+    logger.error("Moderation notification consumer died; restarting", exc_info=task.exception())
+    _start_moderation_consumer()
+
+async def _wait_for_moderation(job_id: str) -> dict:
+    loop = asyncio.get_running_loop()
+    waiter = MODERATION_WAITERS[job_id] = loop.create_future()
+    deadline = loop.time() + MODERATION_TIMEOUT_SECONDS
+    delay = 1
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            status = await _aws(rekognition.get_content_moderation, JobId=job_id)
+            if status["JobStatus"] in ["SUCCEEDED", "FAILED"]:
+                return status
+            if loop.time() >= deadline:
+                raise HTTPException(status_code=504, detail="Rekognition moderation timed out")
+            delay = min(delay * 2, MODERATION_MAX_POLL_SECONDS)
+    finally:
+        MODERATION_WAITERS.pop(job_id, None)
+
+async def _moderation_verdict(key: str) -> str | None:
+    # None: object not stored yet; "": stored but not judged; otherwise the recorded verdict
+    try:
+        tags = await _aws(s3_client.get_object_tagging, Bucket=BUCKET_NAME, Key=key)
+    except (BotoCoreError, ClientError):
+        return None
+    return next((t["Value"] for t in tags["TagSet"] if t["Key"] == MODERATION_TAG), "")
+
+async def _record_moderation_verdict(key: str, verdict: str) -> None:
+    try:
+        await _aws(
+            s3_client.put_object_tagging,
+            Bucket=BUCKET_NAME,
+            Key=key,
+            Tagging={"TagSet": [{"Key": MODERATION_TAG, "Value": verdict}]},
+        )
+    except (BotoCoreError, ClientError):
+        pass  # only costs a repeat moderation job next time
+
+async def _discard_rejected_upload(key: str) -> None:
+    # Upload keys are derived from content, so the rejected video must not stay readable there.
+    # An empty tagged placeholder still remembers the verdict for repeat uploads.
+    try:
+        await _aws(
+            s3_client.put_object,
+            Bucket=BUCKET_NAME,
+            Key=key,
+            Body=b"",
+            Tagging=f"{MODERATION_TAG}=REJECTED",
+        )
+    except (BotoCoreError, ClientError):
+        await _delete_object(key)
+
+async def _delete_object(key: str) -> None:
+    try:
+        await _aws(s3_client.delete_object, Bucket=BUCKET_NAME, Key=key)
+    except (BotoCoreError, ClientError):
+        pass
+
+async def _run_subprocess(*cmd: str) -> bytes:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=FFMPEG_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"{cmd[0]} timed out")
+    finally:
+        # Timed out or cancelled: don't leave the child running
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"{cmd[0]} exited with status {proc.returncode}")
+    return stdout
+
+async def _probe_duration(url: str) -> float | None:
+    if not FFPROBE_BIN:
+        return None
+    try:
+        out = await _run_subprocess(
+            FFPROBE_BIN, "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            "-rw_timeout", FFMPEG_RW_TIMEOUT_US,
+            url,
+        )
+        return float(out.strip())
+    except (OSError, RuntimeError, ValueError):
+        return None
+
+async def _extract_frame(url: str, at_seconds: float) -> bytes:
+    return await _run_subprocess(
+        FFMPEG_BIN, "-v", "error",
+        "-ss", f"{at_seconds:.3f}",
+        "-rw_timeout", FFMPEG_RW_TIMEOUT_US,
+        "-i", url,
+        "-frames:v", "1",
+        "-vf", "scale='min(1280,iw)':-2",
+        "-f", "image2", "-c:v", "mjpeg", "-q:v", "3",
+        "pipe:1",
+    )
+
+async def _premoderate_frames(url: str, duration: float | None, min_confidence: int) -> None:
+    # Rejects obviously unsafe videos in about a second; anything inconclusive falls through to the video job
+    if not (FFMPEG_BIN and duration):
+        return
+    timestamps = [duration * (i + 0.5) / PREMODERATION_FRAMES for i in range(PREMODERATION_FRAMES)]
+    try:
+        frames = await asyncio.gather(*(_extract_frame(url, t) for t in timestamps))
+    except (OSError, RuntimeError):
+        return
+    results = await asyncio.gather(
+        *(
+            _aws(rekognition.detect_moderation_labels, Image={"Bytes": frame}, MinConfidence=min_confidence)
+            for frame in frames
+            if frame
+        ),
+        return_exceptions=True,
+    )
+    if any(isinstance(r, dict) and r.get("ModerationLabels") for r in results):
+        raise HTTPException(status_code=400, detail=MODERATION_REJECTED_DETAIL)
+
 async def _start_video_moderation(bucket: str, key: str, min_confidence: int = 80) -> str:
+    video_url = s3_client.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=300
+    )
+    duration = await _probe_duration(video_url)
+    if MAX_VIDEO_SECONDS:
+        if duration is None:
+            raise HTTPException(status_code=415, detail="Could not determine the video's duration")
+        if duration > MAX_VIDEO_SECONDS:
+            raise HTTPException(status_code=400, detail=f"Video is longer than {MAX_VIDEO_SECONDS} seconds")
+    await _premoderate_frames(video_url, duration, min_confidence)
+
+    params = {}
+    if MODERATION_NOTIFICATIONS:
+        params["NotificationChannel"] = {
+            "SNSTopicArn": REKOGNITION_SNS_TOPIC_ARN,
+            "RoleArn": REKOGNITION_ROLE_ARN,
+        }
     try:
-        response = rekognition.start_content_moderation(
+        response = await _aws(
+            rekognition.start_content_moderation,
             Video={"S3Object": {"Bucket": bucket, "Name": key}},
             MinConfidence=min_confidence,
+            **params,
         )
-        job_id = response["JobId"]
-        while True:
-            status = rekognition.get_content_moderation(JobId=job_id)
-            if status["JobStatus"] in ["SUCCEEDED", "FAILED"]:
-                break
-            await asyncio.sleep(2)
+        status = await _wait_for_moderation(response["JobId"])
         if status["JobStatus"] == "FAILED":
             raise HTTPException(status_code=500, detail="Rekognition moderation failed")
         if status.get("ModerationLabels"):
-            raise HTTPException(status_code=400, detail="Video flagged by content moderation")
+            raise HTTPException(status_code=400, detail=MODERATION_REJECTED_DETAIL)
         return key
     except (BotoCoreError, ClientError) as e:
         raise HTTPException(status_code=500, detail=f"Rekognition error: {e}")
 
+def _retry_after_seconds(headers) -> float | None:
+    try:
+        return max(0.0, min(float(headers.get("retry-after", "")), 60.0))
+    except ValueError:
+        return None
+
+async def _wait_for_runway_task(task_id: str):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RUNWAY_TIMEOUT_SECONDS
+    event = RUNWAY_WAITERS[task_id] = asyncio.Event()
+    delay = 1
+    try:
+        while True:
+            raw = await RUNWAY_CLIENT.tasks.with_raw_response.retrieve(task_id)
+            task = await raw.parse()
+            if task.status in ["SUCCEEDED", "FAILED", "CANCELLED"]:
+                return task
+            if loop.time() >= deadline:
+                raise HTTPException(status_code=504, detail="RunwayML task timed out")
+            try:
+                # A Retry-After from Runway overrides our own schedule for this wait
+                await asyncio.wait_for(event.wait(), timeout=_retry_after_seconds(raw.headers) or delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, RUNWAY_MAX_POLL_SECONDS)
+    finally:
+        RUNWAY_WAITERS.pop(task_id, None)
+
+async def _delete_runway_task(task_id: str) -> None:
+    try:
+        await RUNWAY_CLIENT.tasks.delete(task_id)
+    except Exception:
+        pass
+
 async def _run_runway_video_to_video(model: str, video_url: str, prompt_text: str, ratio: str) -> str:
     if not RUNWAY_SDK_AVAILABLE or RUNWAY_CLIENT is None:
         raise HTTPException(
             status_code=500,
             detail="`runwayml` SDK not installed. Add `runwayml>=1.0.0` to requirements.txt."
         )
+    # Use Gen 4 Aleph for video-to-video
+    create = asyncio.ensure_future(RUNWAY_CLIENT.video_to_video.create(
+        model=model,
+        video_uri=video_url,
+        prompt_text=prompt_text,
+        ratio=ratio
+    ))
     try:
-        # Use Gen 4 Aleph for video-to-video
-        task = RUNWAY_CLIENT.video_to_video.create(
-            model=model,
-            video_uri=video_url,
-            prompt_text=prompt_text,
-            ratio=ratio
-        )
-        output_task = task.wait_for_task_output()
-        output_url = output_task.output[0] if output_task.output else None
-        if not output_url:
-            raise HTTPException(status_code=500, detail="RunwayML returned no output.")
-        return output_url
+        # Shielded: a cancellation mid-request must not orphan a job Runway already accepted
+        task = await asyncio.shield(create)
+    except asyncio.CancelledError:
+        try:
+            created = await asyncio.shield(create)
+        except Exception:
+            pass
+        else:
+            await _delete_runway_task(created.id)
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"RunwayML error: {e}")
+    try:
+        output_task = await _wait_for_runway_task(task.id)
+    except (asyncio.CancelledError, HTTPException):
+        # Cancelled or timed out: nobody will receive this generation, so stop paying for it
+        await _delete_runway_task(task.id)
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"RunwayML error: {e}")
+    if output_task.status != "SUCCEEDED":
+        raise HTTPException(status_code=500, detail=f"RunwayML task {output_task.status.lower()}")
+    output_url = output_task.output[0] if output_task.output else None
+    if not output_url:
+        raise HTTPException(status_code=500, detail="RunwayML returned no output.")
+    return output_url
+
+def _sha256_file(fileobj) -> str:
+    digest = hashlib.sha256()
+    while chunk := fileobj.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def _output_cache_key(model: str, prompt_text: str, ratio: str, source: str) -> str:
+    # JSON keeps field boundaries unambiguous whatever the prompt contains
+    payload = json.dumps([model, prompt_text, ratio, source])
+    digest = hashlib.sha256(payload.encode()).hexdigest()
+    return f"cache/video/{digest}.mp4"
+
+async def _s3_object_exists(key: str) -> bool:
+    try:
+        await _aws(s3_client.head_object, Bucket=BUCKET_NAME, Key=key)
+        return True
+    except (BotoCoreError, ClientError):
+        return False
+
+def _presigned_output_url(key: str) -> str:
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": BUCKET_NAME,
+            "Key": key,
+            "ResponseContentDisposition": "attachment; filename=generated_video.mp4",
+        },
+        ExpiresIn=PRESIGNED_URL_TTL_SECONDS,
+    )
+
+async def _store_output(output_url: str, cache_key: str) -> None:
+    try:
+        await _copy_url_to_bucket(output_url, cache_key, "video/mp4", part_size=OUTPUT_PART_SIZE)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Could not fetch generated video: {e}")
+    except (BotoCoreError, ClientError) as e:
+        raise HTTPException(status_code=500, detail=f"Could not store generated video: {e}")
+
+async def _moderate_and_generate(request: VideoToVideoRequest, src_key: str, needs_moderation: bool) -> str:
+    if needs_moderation and not MODERATION_OVERLAP:
+        await _start_video_moderation(BUCKET_NAME, src_key)
+        needs_moderation = False
+
+    runway = asyncio.create_task(_run_runway_video_to_video(
+        model=RUNWAY_MODEL,
+        video_url=_public_s3_url(src_key),
+        prompt_text=request.prompt_text,
+        ratio=request.ratio
+    ))
+    if not needs_moderation:
+        return await runway
+    # Moderation overlaps the much slower generation; a rejection cancels the Runway task
+    moderation = asyncio.create_task(_start_video_moderation(BUCKET_NAME, src_key))
+    try:
+        done, _ = await asyncio.wait({moderation, runway}, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+        return runway.result()
+    finally:
+        moderation.cancel()
+        runway.cancel()
+
+async def _generate_output(request: VideoToVideoRequest, input_url: str, src_key: str, cache_key: str) -> None:
+    # An identical pipeline may have stored the output after our caller's cache check
+    if await _s3_object_exists(cache_key):
+        return
+
+    # Only a recorded APPROVED verdict proves an object has passed moderation; every
+    # other input, in our bucket or not, goes through the full check (duration cap included)
+    copied = not src_key
+    if src_key:
+        verdict = await _moderation_verdict(src_key)
+        if verdict == "REJECTED":
+            raise HTTPException(status_code=400, detail=MODERATION_REJECTED_DETAIL)
+        needs_moderation = verdict != "APPROVED"
+    else:
+        src_key = await _copy_external_video_to_bucket(input_url)
+        needs_moderation = True
+
+    try:
+        output_url = await _moderate_and_generate(request, src_key, needs_moderation)
+    except HTTPException as e:
+        # Rejected content must not stay publicly readable in our bucket
+        if e.detail == MODERATION_REJECTED_DETAIL:
+            if copied:
+                await _delete_object(src_key)
+            elif src_key.startswith(UPLOAD_KEY_PREFIX):
+                await _discard_rejected_upload(src_key)
+        raise
+
+    # Persist once; clients download from S3 instead of through this server
+    await _store_output(output_url, cache_key)
 
 # -----------------------------------------------------------------------------
 # Routes
@@ -164,45 +820,67 @@ def healthz():
 @app.post("/upload-video")
 async def upload_video(file: UploadFile = File(...)):
     ext = file.filename.split(".")[-1].lower()
-    if ext not in ["mp4", "mov", "webm", "m4v"]:
+    if ext not in VIDEO_CONTAINERS:
         return JSONResponse(status_code=400, content={"error": "Invalid video format."})
-    key = f"uploads/video/{uuid.uuid4()}.{ext}"
-    
-    s3_client.upload_fileobj(
-        file.file,
-        BUCKET_NAME,
-        key,
-        ExtraArgs={"ContentType": file.content_type or f"video/{ext}"}
-    )
 
-    await _start_video_moderation(BUCKET_NAME, key)
+    # Don't trust the extension: a mislabeled file would still cost an S3 upload and a Rekognition job
+    head = await file.read(16)
+    await file.seek(0)
+    if _video_container(head) != VIDEO_CONTAINERS[ext]:
+        return JSONResponse(status_code=415, content={"error": "File content is not a supported video."})
+
+    # Uploads are keyed by content, so a repeat upload skips the PUT and, once judged, moderation too
+    digest = await run_in_threadpool(_sha256_file, file.file)
+    key = f"{UPLOAD_KEY_PREFIX}{digest}.{ext}"
+    verdict = await _moderation_verdict(key)
+    if verdict == "REJECTED":
+        raise HTTPException(status_code=400, detail=MODERATION_REJECTED_DETAIL)
+    if verdict == "APPROVED":
+        return {"url": _public_s3_url(key), "status": "APPROVED"}
+
+    if verdict is None:
+        async with S3_SEM:
+            await _multipart_upload(
+                _iter_upload(file, UPLOAD_PART_SIZE), key, file.content_type or f"video/{ext}"
+            )
+
+    try:
+        await _start_video_moderation(BUCKET_NAME, key)
+    except HTTPException as e:
+        if e.detail == MODERATION_REJECTED_DETAIL:
+            await _discard_rejected_upload(key)
+        raise
+    await _record_moderation_verdict(key, "APPROVED")
 
     return {"url": _public_s3_url(key), "status": "APPROVED"}
 
 @app.post("/generate-video")
 async def generate_video(request: VideoToVideoRequest):
-    request.model = "gen4_aleph"  # FORCE Gen 4 Aleph
-
     input_url = str(request.video)
-    if _is_s3_url(input_url) and _s3_key_from_presigned_or_path(input_url):
-        src_key = _s3_key_from_presigned_or_path(input_url)
-    else:
-        src_key = await _copy_external_video_to_bucket(input_url)
+    src_key = _s3_key_from_presigned_or_path(input_url) if _is_s3_url(input_url) else ""
 
-    s3_url = _public_s3_url(src_key)
-
-    output_url = await _run_runway_video_to_video(
-        model=request.model,
-        video_url=s3_url,
-        prompt_text=request.prompt_text,
-        ratio=request.ratio
-    )
+    # Identical requests reuse the stored output instead of paying for another Runway job
+    cache_key = _output_cache_key(RUNWAY_MODEL, request.prompt_text, request.ratio, src_key or input_url)
+    # Concurrent identical requests share a single pipeline run. INFLIGHT is checked before
+    # and again after the HEAD, since a pipeline may start or finish while it's pending.
+    pipeline = INFLIGHT.get(cache_key)
+    if pipeline is None and not await _s3_object_exists(cache_key):
+        pipeline = INFLIGHT.get(cache_key)
+        if pipeline is None:
+            pipeline = asyncio.create_task(_generate_output(request, input_url, src_key, cache_key))
+            INFLIGHT[cache_key] = pipeline
+            pipeline.add_done_callback(lambda _: INFLIGHT.pop(cache_key, None))
+    if pipeline is not None:
+        await asyncio.shield(pipeline)
 
-    video_resp = requests.get(output_url, stream=True, timeout=300)
-    video_resp.raise_for_status()
+    return {"output_url": _presigned_output_url(cache_key)}
 
-    return StreamingResponse(
-        io.BytesIO(video_resp.content),
-        media_type="video/mp4",
-        headers={"Content-Disposition": f"attachment; filename=generated_video.mp4"}
-    )
+@app.post("/runway-callback")
+async def runway_callback(payload: dict, token: str = ""):
+    if not RUNWAY_CALLBACK_TOKEN or not hmac.compare_digest(token.encode(), RUNWAY_CALLBACK_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid callback token")
+    # Only wakes the waiter; the task itself is re-read from the Runway API
+    event = RUNWAY_WAITERS.get(str(payload.get("id", "")))
+    if event:
+        event.set()
+    return {"ok": True}